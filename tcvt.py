@@ -41,10 +41,12 @@ import curses
 import errno
 import time
 import optparse
+import re
 
 def init_color_pairs(invert):
     """
     Set color pairs for ncurses where each color is between 0 and COLORS.
+    Returns a list mapping fg * 8 + bg to the attribute selecting the pair.
     """
     foreground = curses.COLOR_BLACK
     background = curses.COLOR_WHITE
@@ -61,6 +63,7 @@ def init_color_pairs(invert):
                                  curses.COLOR_MAGENTA, curses.COLOR_CYAN)):
             if fi != 0 or bi != 0:
                 curses.init_pair(fi*8+bi, fc, bc)
+    return [get_color(fg, bg) for fg in range(8) for bg in range(8)]
 
 def get_color(fg=1, bg=0):
     return curses.color_pair(((fg + 1) % 8) * 8 + bg)
@@ -69,12 +72,14 @@ class Simple:
     def __init__(self, curseswindow):
         self.screen = curseswindow
         self.screen.scrollok(1)
+        # A new Simple is created whenever the window size changes.
+        self.maxyx = self.screen.getmaxyx()
 
     def getmaxyx(self):
-        return self.screen.getmaxyx()
+        return self.maxyx
 
     def move(self, ypos, xpos):
-        ym, xm = self.getmaxyx()
+        ym, xm = self.maxyx
         self.screen.move(max(0, min(ym - 1, ypos)), max(0, min(xm - 1, xpos)))
 
     def relmove(self, yoff, xoff):
@@ -84,8 +89,12 @@ class Simple:
     def addch(self, char):
         self.screen.addch(char)
 
+    def addstr(self, string):
+        self.screen.addstr(string)
+
     def refresh(self):
-        self.screen.refresh()
+        self.screen.noutrefresh()
+        curses.doupdate()
 
     def getyx(self):
         return self.screen.getyx()
@@ -96,26 +105,24 @@ class Simple:
     def clrtobot(self):
         self.screen.clrtobot()
 
-    def attron(self, attr):
-        self.screen.attron(attr)
-
     def clrtoeol(self):
         self.screen.clrtoeol()
 
-    def delch(self):
-        self.screen.delch()
+    def delch(self, n=1):
+        for _ in range(n):
+            self.screen.delch()
 
     def attrset(self, attr):
         self.screen.attrset(attr)
 
-    def insertln(self):
-        self.screen.insertln()
+    def insertln(self, n=1):
+        self.screen.insdelln(n)
 
-    def insch(self, char):
-        self.screen.insch(char)
+    def insstr(self, string):
+        self.screen.insstr(string)
 
-    def deleteln(self):
-        self.screen.deleteln()
+    def deleteln(self, n=1):
+        self.screen.insdelln(-n)
 
     def inch(self):
         return self.screen.inch()
@@ -133,134 +140,125 @@ class Columns:
         self.columnwidth = (width - (numcolumns - 1)) // numcolumns
         if self.columnwidth <= 0:
             raise BadWidth("resulting column width too small")
-        self.windows = []
-        for i in range(numcolumns):
-            window = self.screen.derwin(self.height, self.columnwidth,
-                                        0, i * (self.columnwidth + 1))
-            window.scrollok(1)
-            self.windows.append(window)
+        self.maxyx = (self.height * numcolumns, self.columnwidth)
+        # The columns are consecutive parts of a single pad holding the whole
+        # logical screen. Only refresh maps them to their place on the screen.
+        self.pad = curses.newpad(self.height * numcolumns, self.columnwidth)
+        self.pad.scrollok(1)
+        # Screen x coordinate of each column.
+        self.offsets = [i * (self.columnwidth + 1) for i in range(numcolumns)]
         if reverse:
-            self.windows.reverse()
+            self.offsets.reverse()
+        # Pick up what is shown on the screen like overlaid windows would.
+        for index, x in enumerate(self.offsets):
+            self.screen.overwrite(self.pad, 0, x, index * self.height, 0,
+                                  (index + 1) * self.height - 1,
+                                  self.columnwidth - 1)
         self.ypos, self.xpos = 0, 0
         for i in range(1, numcolumns):
             self.screen.vline(0, i * (self.columnwidth + 1) - 1,
                               curses.ACS_VLINE, self.height)
+        # The screen itself only holds the separators, which never change.
+        self.screen.noutrefresh()
         self.attrs = 0
 
-    @property
-    def curwin(self):
-        return self.windows[self.ypos // self.height]
-
-    @property
-    def curypos(self):
-        return self.ypos % self.height
-
-    @property
-    def curxpos(self):
-        return self.xpos
+    def detach(self):
+        """Copy the columns to the underlying window before it is used
+        directly again."""
+        for index, x in enumerate(self.offsets):
+            self.pad.overwrite(self.screen, index * self.height, 0, 0, x,
+                               self.height - 1, x + self.columnwidth - 1)
 
     def getmaxyx(self):
-        return (self.height * self.numcolumns, self.columnwidth)
+        return self.maxyx
 
     def move(self, ypos, xpos):
-        height, width = self.getmaxyx()
+        height, width = self.maxyx
         self.ypos = max(0, min(height - 1, ypos))
         self.xpos = max(0, min(width - 1, xpos))
         self.fix_cursor()
 
     def fix_cursor(self):
-        self.curwin.move(self.curypos, self.curxpos)
+        self.pad.move(self.ypos, self.xpos)
 
     def relmove(self, yoff, xoff):
         self.move(self.ypos + yoff, self.xpos + xoff)
 
     def addch(self, char):
         if self.xpos == self.columnwidth - 1:
-            self.curwin.insch(self.curypos, self.curxpos, char, self.attrs)
-            if self.ypos + 1 == 2 * self.height:
+            self.pad.insch(self.ypos, self.xpos, char, self.attrs)
+            if self.ypos + 1 == self.maxyx[0]:
                 self.scroll()
                 self.move(self.ypos, 0)
             else:
                 self.move(self.ypos + 1, 0)
         else:
-            self.curwin.addch(self.curypos, self.curxpos, char, self.attrs)
+            self.pad.addch(self.ypos, self.xpos, char, self.attrs)
             self.xpos += 1
 
+    def addstr(self, string):
+        # Write the part fitting before the last column in one call. Only the
+        # character landing in the last column needs the wrapping addch.
+        padaddstr = self.pad.addstr
+        lastx = self.columnwidth - 1
+        while string:
+            count = min(len(string), lastx - self.xpos)
+            if count > 0:
+                padaddstr(self.ypos, self.xpos, string[:count], self.attrs)
+                self.xpos += count
+            if count < len(string):
+                self.addch(ord(string[count:count + 1]))
+            string = string[count + 1:]
+
+    def refresh_column(self, index, lines, cols):
+        x = self.offsets[index]
+        # curses may shrink the screen before resized replaces this object.
+        # Only show what still fits, since pnoutrefresh fails otherwise.
+        if x < cols:
+            self.pad.noutrefresh(index * self.height, 0, 0, x,
+                                 min(self.height, lines) - 1,
+                                 min(x + self.columnwidth, cols) - 1)
+
     def refresh(self):
-        self.screen.refresh()
-        for window in self.windows:
-            if window is not self.curwin:
-                window.refresh()
-        self.curwin.refresh()
+        lines, cols = self.screen.getmaxyx()
+        current = self.ypos // self.height
+        for index in range(self.numcolumns):
+            if index != current:
+                self.refresh_column(index, lines, cols)
+        # The column refreshed last determines the cursor position.
+        self.refresh_column(current, lines, cols)
+        curses.doupdate()
 
     def getyx(self):
         return (self.ypos, self.xpos)
 
-    def scroll_up(self, index):
-        """Copy first line of the window with given index to last line of the
-        previous window and scroll up the given window."""
-        assert index > 0
-        previous = self.windows[index - 1]
-        previous.move(self.height - 1, 0)
-        for x in range(self.columnwidth - 1):
-            previous.addch(self.windows[index].inch(0, x))
-        previous.insch(self.windows[index].inch(0, self.columnwidth - 1))
-        self.fix_cursor()
-        self.windows[index].scroll()
-
-    def scroll_down(self, index):
-        """Scroll down the window with given index and copy the last line of
-        the previous window to the first line of the given window."""
-        assert index > 0
-        current = self.windows[index]
-        previous = self.windows[index - 1]
-        current.scroll(-1)
-        current.move(0, 0)
-        for x in range(self.columnwidth - 1):
-            current.addch(previous.inch(self.height - 1, x))
-        current.insch(previous.inch(self.height - 1, self.columnwidth - 1))
-        self.fix_cursor()
-
     def scroll(self):
-        self.windows[0].scroll()
-        for i in range(1, self.numcolumns):
-            self.scroll_up(i)
+        self.pad.scroll()
 
     def clrtobot(self):
-        index = self.ypos // self.height
-        for i in range(index + 1, self.numcolumns):
-            self.windows[i].clear()
-        self.windows[index].clrtobot()
-
-    def attron(self, attr):
-        self.attrs |= attr
+        self.pad.clrtobot()
 
     def clrtoeol(self):
-        self.curwin.clrtoeol()
+        self.pad.clrtoeol()
 
-    def delch(self):
-        self.curwin.delch(self.curypos, self.curxpos)
+    def delch(self, n=1):
+        for _ in range(n):
+            self.pad.delch(self.ypos, self.xpos)
 
     def attrset(self, attr):
         self.attrs = attr
 
-    def insertln(self):
-        index = self.ypos // self.height
-        for i in reversed(range(index + 1, self.numcolumns)):
-            self.scroll_down(i)
-        self.curwin.insertln()
+    def insertln(self, n=1):
+        self.pad.insdelln(n)
 
-    def insch(self, char):
-        self.curwin.insch(self.curypos, self.curxpos, char, self.attrs)
+    def insstr(self, string):
+        self.pad.insstr(self.ypos, self.xpos, string, self.attrs)
 
-    def deleteln(self):
-        index = self.ypos // self.height
-        self.windows[index].deleteln()
-        for i in range(index + 1, self.numcolumns):
-            self.scroll_up(i)
+    def deleteln(self, n=1):
+        self.pad.insdelln(-n)
 
     def inch(self):
-        return self.curwin.inch(self.curypos, self.curxpos)
+        return self.pad.inch(self.ypos, self.xpos)
 
 def acs_map():
     """call after curses.initscr"""
@@ -313,57 +311,145 @@ SIMPLE_CHARACTERS = bytearray(
     b'0123456789@:~$ .#!/_(),[]=-+*\'"|<>%&\\?;`^{}' +
     b'\xb4\xb6\xb7\xc3\xc4\xd6\xdc\xe4\xe9\xfc\xf6')
 
+# Indexed by byte value, nonzero for SIMPLE_CHARACTERS.
+SIMPLE_TABLE = bytearray(1 if char in SIMPLE_CHARACTERS else 0
+                         for char in range(256))
+
+# Maximal runs of printable ASCII characters. They can be written without
+# going through the state machine byte by byte.
+PRINTABLE_RE = re.compile(b"[" + re.escape(bytes(bytearray(
+    char for char in SIMPLE_CHARACTERS if char < 0x80))) + b"]+")
+
+# A complete control sequence ESC [ params final as understood by
+# feed_esc_opbr and feed_esc_opbr_next.
+CSI_RE = re.compile(b"\x1b\\[([0-9][0-9;]*)?([@-~])")
+
+# Attributes enabled by SGR parameters.
+SGR_ATTRIBUTES = {
+    1: curses.A_BOLD,
+    4: curses.A_UNDERLINE,
+    5: curses.A_BLINK,
+    7: curses.A_REVERSE,
+    8: curses.A_INVIS,
+}
+
+# struct winsize as passed to TIOCSWINSZ.
+WINSIZE = struct.Struct("HHHH")
+
 class Terminal:
     def __init__(self, acsc, columns, reverse=False, invert=False):
-        self.mode = (self.feed_simple,)
+        # The state machine is the method handling the next byte.
+        self.mode = self.feed_simple
+        # Numeric parameters of the control sequence being parsed.
+        self.csi_params = []
         self.realscreen = None
+        # Size of realscreen that self.screen was built for.
+        self.realsize = None
         self.screen = None
         self.fg = self.bg = 0
+        self.color_pairs = None # initialized in start
+        self.attrs = 0
         self.graphics_font = False
         self.graphics_chars = acsc # really initialized after
+        self.graphics_table = None  # initialized in start
         self.lastchar = ord(b' ')
         self.columns = columns
         self.reverse = reverse
         self.invert = invert
+        self.simple_controls = [None] * 256
+        self.simple_controls[ord('\a')] = self.do_bel
+        self.simple_controls[ord('\b')] = self.do_cub1
+        self.simple_controls[ord('\n')] = self.do_ind
+        self.simple_controls[ord('\r')] = self.do_cr
+        self.simple_controls[ord('\t')] = self.do_ht
+        # Control sequences without parameters.
+        self.csi_controls = {
+            ord('A'): self.do_cuu1,
+            ord('B'): self.do_cud1,
+            ord('C'): self.do_cuf1,
+            ord('D'): self.do_cub1,
+            ord('H'): self.do_home,
+            ord('J'): self.do_ed,
+            ord('L'): self.do_il1,
+            ord('M'): self.do_dl1,
+            ord('K'): self.do_el,
+            ord('P'): self.do_dch1,
+            }
+        # Control sequences taking a single count.
+        self.csi_count_controls = {
+            ord('A'): self.do_cuu,
+            ord('B'): self.do_cud,
+            ord('C'): self.do_cuf,
+            ord('D'): self.do_cub,
+            ord('L'): self.do_il,
+            ord('M'): self.do_dl,
+            ord('P'): self.do_dch,
+            ord('X'): self.do_ech,
+            ord('@'): self.do_ich,
+            }
+
+    def setscreen(self, screen):
+        self.screen = screen
+        self.screen.attrset(self.attrs)
 
     def switchmode(self):
         if isinstance(self.screen, Columns):
-            self.screen = Simple(self.realscreen)
+            self.screen.detach()
+            self.setscreen(Simple(self.realscreen))
         else:
-            self.screen = Columns(self.realscreen, self.columns)
+            self.setscreen(Columns(self.realscreen, self.columns))
         self.screen.refresh()
 
     def resized(self):
         # The refresh call causes curses to notice the new dimensions.
         self.realscreen.refresh()
+        size = self.realscreen.getmaxyx()
+        if size == self.realsize:
+            # Interrupted by some other signal. Keep the current contents
+            # rather than clearing them and repainting everything.
+            return
+        self.realsize = size
         self.realscreen.clear()
         try:
-            self.screen = Columns(self.realscreen, self.columns,
-                                  reverse=self.reverse)
+            self.setscreen(Columns(self.realscreen, self.columns,
+                                   reverse=self.reverse))
         except BadWidth:
-            self.screen = Simple(self.realscreen)
+            self.setscreen(Simple(self.realscreen))
 
     def resizepty(self, ptyfd):
-        ym, xm = self.screen.getmaxyx()
+        ym, xm = self.screen.maxyx
         fcntl.ioctl(ptyfd, termios.TIOCSWINSZ,
-                    struct.pack("HHHH", ym, xm, 0, 0))
+                    WINSIZE.pack(ym, xm, 0, 0))
 
     def addch(self, char):
         self.lastchar = char
         self.screen.addch(char)
 
+    def addstr(self, string):
+        self.lastchar = ord(string[-1:])
+        self.screen.addstr(string)
+
     def start(self):
         self.realscreen = curses.initscr()
+        self.realsize = self.realscreen.getmaxyx()
         self.realscreen.nodelay(1)
         self.realscreen.keypad(1)
         curses.start_color()
         curses.use_default_colors()
-        init_color_pairs(self.invert)
-        self.screen = Columns(self.realscreen, self.columns,
-                              reverse=self.reverse)
+        self.color_pairs = init_color_pairs(self.invert)
+        self.setscreen(Columns(self.realscreen, self.columns,
+                               reverse=self.reverse))
         curses.noecho()
         curses.raw()
         self.graphics_chars = compose_dicts(self.graphics_chars, acs_map())
+        # Index the graphics characters by byte, so feed_graphics does a
+        # single list lookup.
+        self.graphics_table = [None] * 256
+        for char, graphic in self.graphics_chars.items():
+            self.graphics_table[char] = graphic
+        # some applications appear to use VT100 names?
+        if self.graphics_table[ord(b'q')] is None:
+            self.graphics_table[ord(b'q')] = curses.ACS_HLINE
 
     def stop(self):
         curses.noraw()
@@ -373,14 +459,9 @@ class Terminal:
     def do_bel(self):
         curses.beep()
 
-    def do_blink(self):
-        self.screen.attron(curses.A_BLINK)
-
-    def do_bold(self):
-        self.screen.attron(curses.A_BOLD)
-
     def do_cr(self):
-        self.screen.relmove(0, -9999)
+        y, _ = self.screen.getyx()
+        self.screen.move(y, 0)
 
     def do_cub(self, n):
         self.screen.relmove(0, -n)
@@ -407,22 +488,30 @@ class Terminal:
         self.do_cuu(1)
 
     def do_dch(self, n):
-        for _ in range(n):
-            self.screen.delch()
+        # The count comes from the application, only the rest of the line
+        # can be affected.
+        _, x = self.screen.getyx()
+        self.screen.delch(min(n, self.screen.maxyx[1] - x))
 
     def do_dch1(self):
         self.do_dch(1)
 
     def do_dl(self, n):
-        for _ in range(n):
-            self.screen.deleteln()
+        self.screen.deleteln(n)
 
     def do_dl1(self):
         self.do_dl(1)
 
     def do_ech(self, n):
-        for _ in range(n):
-            self.screen.addch(ord(b' '))
+        y, x = self.screen.getyx()
+        rest = self.screen.maxyx[1] - x
+        if n < rest:
+            self.screen.addstr(b' ' * n)
+            self.screen.move(y, x)
+        else:
+            # Inserting blanks up to the end of the line pushes out the rest
+            # of it without wrapping.
+            self.screen.insstr(b' ' * rest)
 
     def do_ed(self):
         self.screen.clrtobot()
@@ -433,8 +522,7 @@ class Terminal:
     def do_el1(self):
         y, x = self.screen.getyx()
         self.screen.move(y, 0)
-        for _ in range(x):
-            self.screen.addch(ord(b' '))
+        self.screen.addstr(b' ' * x)
 
     def do_home(self):
         self.screen.move(0, 0)
@@ -445,35 +533,39 @@ class Terminal:
 
     def do_ht(self):
         y, x = self.screen.getyx()
-        _, xm = self.screen.getmaxyx()
-        x = min(x + 8 - x % 8, xm - 1)
+        x = min(x + 8 - x % 8, self.screen.maxyx[1] - 1)
         self.screen.move(y, x)
 
     def do_ich(self, n):
-        for _ in range(n):
-            self.screen.insch(ord(b' '))
+        _, x = self.screen.getyx()
+        self.screen.insstr(b' ' * min(n, self.screen.maxyx[1] - x))
 
     def do_il(self, n):
-        for _ in range(n):
-            self.screen.insertln()
+        self.screen.insertln(n)
 
     def do_il1(self):
         self.do_il(1)
 
     def do_ind(self):
         y, _ = self.screen.getyx()
-        ym, _ = self.screen.getmaxyx()
-        if y + 1 == ym:
+        if y + 1 == self.screen.maxyx[0]:
             self.screen.scroll()
             self.screen.move(y, 0)
         else:
             self.screen.move(y+1, 0)
 
-    def do_invis(self):
-        self.screen.attron(curses.A_INVIS)
-
-    def do_smul(self):
-        self.screen.attron(curses.A_UNDERLINE)
+    def do_rep(self, n):
+        # Do not repeat beyond the cells left on the screen, whatever count
+        # the application asked for.
+        y, x = self.screen.getyx()
+        ym, xm = self.screen.maxyx
+        n = min(n, (ym - y) * xm - x)
+        if self.lastchar < 0x80:
+            self.screen.addstr(struct.pack("B", self.lastchar) * n)
+        else:
+            # Graphics characters cannot be expressed as a string.
+            for _ in range(n):
+                self.screen.addch(self.lastchar)
 
     def do_vpa(self, n):
         _, x = self.screen.getyx()
@@ -481,144 +573,164 @@ class Terminal:
 
     def feed_reset(self):
         if self.graphics_font:
-            self.mode = (self.feed_graphics,)
+            self.mode = self.feed_graphics
         else:
-            self.mode = (self.feed_simple,)
+            self.mode = self.feed_simple
 
     def feed(self, char):
-        self.mode[0](char, *self.mode[1:])
+        self.mode(char)
+
+    def feed_bytes(self, data, strict=False):
+        """Feed a chunk of output. Runs of printable characters are written
+        with a single addstr and complete control sequences are recognized
+        as a whole. Unless strict is set, a byte that cannot be interpreted
+        resets the state machine."""
+        chars = bytearray(data)
+        pos, end = 0, len(chars)
+        # Bind what is used per iteration once. Accessing a method creates
+        # a new bound method object each time.
+        feed_simple, feed_graphics = self.feed_simple, self.feed_graphics
+        match_printable, match_csi = PRINTABLE_RE.match, CSI_RE.match
+        addstr, feed_csi = self.addstr, self.feed_csi
+        while pos < end:
+            if self.mode == feed_simple:
+                match = match_printable(data, pos)
+                if match:
+                    addstr(match.group())
+                    pos = match.end()
+                    if pos == end:
+                        break
+            char = chars[pos]
+            match = None
+            if char == 0x1b and self.mode in (feed_simple, feed_graphics):
+                match = match_csi(data, pos)
+            try:
+                if match:
+                    pos = match.end()
+                    feed_csi(match.group(1), ord(match.group(2)))
+                else:
+                    pos += 1
+                    self.mode(char)
+            except ValueError:
+                if strict:
+                    raise
+                self.feed_reset()
+
+    def feed_csi(self, params, char):
+        """Handle the control sequence ESC [ params char, where params is
+        None or the parameter bytes."""
+        if params is None:
+            self.feed_esc_opbr(char)
+        else:
+            self.csi_params = [int(p) if p else 0 for p in params.split(b";")]
+            self.feed_esc_opbr_next(char)
 
     def feed_simple(self, char):
-        func = {
-            ord('\a'): self.do_bel,
-            ord('\b'): self.do_cub1,
-            ord('\n'): self.do_ind,
-            ord('\r'): self.do_cr,
-            ord('\t'): self.do_ht,
-            }.get(char)
+        if SIMPLE_TABLE[char]:
+            self.addch(char)
+            return
+        func = self.simple_controls[char]
         if func:
             func()
-        elif char in SIMPLE_CHARACTERS:
-            self.addch(char)
         elif char == 0x1b:
-            self.mode = (self.feed_esc,)
+            self.mode = self.feed_esc
         else:
             raise ValueError("feed %r" % char)
 
     def feed_graphics(self, char):
-        if char == 0x1b:
-            self.mode = (self.feed_esc,)
-        elif char in self.graphics_chars:
-            self.addch(self.graphics_chars[char])
-        elif char == ord(b'q'):  # some applications appear to use VT100 names?
-            self.addch(curses.ACS_HLINE)
+        graphic = self.graphics_table[char]
+        if graphic is not None:
+            self.addch(graphic)
+        elif char == 0x1b:
+            self.mode = self.feed_esc
         else:
             raise ValueError("graphics %r" % char)
 
     def feed_esc(self, char):
         if char == ord(b'['):
-            self.mode = (self.feed_esc_opbr,)
+            self.mode = self.feed_esc_opbr
         else:
             raise ValueError("feed esc %r" % char)
 
     def feed_esc_opbr(self, char):
         self.feed_reset()
-        func = {
-            ord('A'): self.do_cuu1,
-            ord('B'): self.do_cud1,
-            ord('C'): self.do_cuf1,
-            ord('D'): self.do_cub1,
-            ord('H'): self.do_home,
-            ord('J'): self.do_ed,
-            ord('L'): self.do_il1,
-            ord('M'): self.do_dl1,
-            ord('K'): self.do_el,
-            ord('P'): self.do_dch1,
-            }.get(char)
+        func = self.csi_controls.get(char)
         if func:
             func()
         elif char == ord(b'm'):
-            self.feed_esc_opbr_next(char, bytearray(b'0'))
-        elif char in bytearray(b'0123456789'):
-            self.mode = (self.feed_esc_opbr_next, bytearray((char,)))
+            self.csi_params = [0]
+            self.feed_esc_opbr_next(char)
+        elif 0x30 <= char <= 0x39:
+            self.mode = self.feed_esc_opbr_next
+            self.csi_params = [char - 0x30]
         else:
             raise ValueError("feed esc [ %r" % char)
 
-    def feed_color(self, code):
-        func = {
-            1: self.do_bold,
-            4: self.do_smul,
-            5: self.do_blink,
-            8: self.do_invis,
-            }.get(code)
-        if func:
-            func()
-        elif code == 0:
+    def feed_color(self, code, attr):
+        """Return the attributes attr modified by the SGR parameter code."""
+        if code in SGR_ATTRIBUTES:
+            return attr | SGR_ATTRIBUTES[code]
+        if code == 0:
             self.fg = self.bg = 0
-            self.screen.attrset(0)
-        elif code == 7:
-            self.screen.attron(curses.A_REVERSE)
-        elif code == 10:
-            self.graphics_font = False
+            return 0
+        if code in (10, 11):
+            self.graphics_font = code == 11
             self.feed_reset()
-        elif code == 11:
-            self.graphics_font = True
-            self.feed_reset()
-        elif 30 <= code <= 37:
+            return attr
+        if 30 <= code <= 37:
             self.fg = code - 30
-            self.screen.attron(get_color(self.fg, self.bg))
         elif code == 39:
             self.fg = 7
-            self.screen.attron(get_color(self.fg, self.bg))
         elif 40 <= code <= 47:
             self.bg = code - 40
-            self.screen.attron(get_color(self.fg, self.bg))
         elif code == 49:
             self.bg = 0
-            self.screen.attron(get_color(self.fg, self.bg))
         else:
             raise ValueError("feed esc [ %r m" % code)
-
-    def feed_esc_opbr_next(self, char, prev):
+        return ((attr & ~curses.A_COLOR) |
+                self.color_pairs[self.fg * 8 + self.bg])
+
+    def feed_esc_opbr_next(self, char):
+        params = self.csi_params
+        if 0x30 <= char <= 0x39:
+            params[-1] = params[-1] * 10 + char - 0x30
+            return
+        if char == ord(b';'):
+            params.append(0)
+            return
         self.feed_reset()
-        func = {
-            ord('A'): self.do_cuu,
-            ord('B'): self.do_cud,
-            ord('C'): self.do_cuf,
-            ord('D'): self.do_cub,
-            ord('L'): self.do_il,
-            ord('M'): self.do_dl,
-            ord('P'): self.do_dch,
-            ord('X'): self.do_ech,
-            ord('@'): self.do_ich,
-            }.get(char)
-        if func and prev.isdigit():
-            func(int(prev))
-        elif char in bytearray(b'0123456789;'):
-            self.mode = (self.feed_esc_opbr_next, prev + bytearray((char,)))
+        func = self.csi_count_controls.get(char)
+        if func and len(params) == 1:
+            func(params[0])
         elif char == ord(b'm'):
-            parts = prev.split(b';')
-            for p in parts:
-                self.feed_color(int(p))
+            # Compute the combined attributes of all parameters and apply
+            # them at once.
+            attr = self.attrs
+            try:
+                for p in params:
+                    attr = self.feed_color(p, attr)
+            finally:
+                # The parameters before an unsupported one stay in effect,
+                # consistent with the fg and bg feed_color already set.
+                self.attrs = attr
+                self.screen.attrset(attr)
         elif char == ord(b'H'):
-            parts = prev.split(b';')
-            if len(parts) != 2:
-                raise ValueError("feed esc [ %r H" % parts)
-            self.screen.move(*map((-1).__add__, map(int, parts)))
-        elif prev == bytearray(b'2') and char == ord(b'J'):
+            if len(params) != 2:
+                raise ValueError("feed esc [ %r H" % params)
+            self.screen.move(params[0] - 1, params[1] - 1)
+        elif params == [2] and char == ord(b'J'):
             self.screen.move(0, 0)
             self.screen.clrtobot()
-        elif char == ord(b'd') and prev.isdigit():
-            self.do_vpa(int(prev) - 1)
-        elif char == ord(b'b') and prev.isdigit():
-            for _ in range(int(prev)):
-                self.screen.addch(self.lastchar)
-        elif char == ord(b'G') and prev.isdigit():
-            self.do_hpa(int(prev) - 1)
-        elif char == ord(b'K') and prev == b'1':
+        elif char == ord(b'd') and len(params) == 1:
+            self.do_vpa(params[0] - 1)
+        elif char == ord(b'b') and len(params) == 1:
+            self.do_rep(params[0])
+        elif char == ord(b'G') and len(params) == 1:
+            self.do_hpa(params[0] - 1)
+        elif char == ord(b'K') and params == [1]:
             self.do_el1()
         else:
-            raise ValueError("feed esc [ %r %r" % (prev, char))
+            raise ValueError("feed esc [ %r %r" % (params, char))
 
 SYMBOLIC_KEYMAPPING = {
     ord(b"\n"): "cr",
@@ -659,6 +771,50 @@ def set_cloexec(fd):
     flags |= fcntl.FD_CLOEXEC
     fcntl.fcntl(fd, fcntl.F_SETFD, flags)
 
+def set_nonblock(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL, 0)
+    flags |= os.O_NONBLOCK
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
+def get_winsize(fd):
+    ym, xm, _, _ = WINSIZE.unpack(fcntl.ioctl(fd, termios.TIOCGWINSZ,
+                                              WINSIZE.pack(0, 0, 0, 0)))
+    return ym, xm
+
+def write_all(fd, data):
+    """Write all of data to the non-blocking fd, waiting for it to become
+    writable whenever the kernel buffer is full."""
+    while data:
+        try:
+            written = os.write(fd, data)
+        except OSError as err:
+            if err.errno != errno.EAGAIN:
+                raise
+            select.select([], [fd], [])
+            continue
+        data = data[written:]
+
+def read_available(fd, bufsize, limit):
+    """Read from the non-blocking fd until it would block or at least limit
+    bytes were collected. Returns None when the fd reached end of file or
+    failed before anything could be read."""
+    chunks = []
+    size = 0
+    while size < limit:
+        try:
+            chunk = os.read(fd, bufsize)
+        except OSError as err:
+            if err.errno == errno.EAGAIN:
+                break
+            chunk = b""
+        if not chunk:
+            if not chunks:
+                return None
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+    return b"".join(chunks)
+
 def main():
     # Options
     parser = optparse.OptionParser()
@@ -704,55 +860,97 @@ def main():
     try:
         t.start()
         t.resizepty(masterfd)
+        set_nonblock(masterfd)
+        poller = select.poll()
+        poller.register(0, select.POLLIN)
+        poller.register(masterfd, select.POLLIN)
         refreshpending = None
+        # When the pending refresh was scheduled and when we last finished
+        # feeding output from the pty.
+        refreshstart = lastdata = 0
+        # Milliseconds to wait for further output before refreshing once the
+        # pty has gone quiet.
+        idlewait = 0
+        # Size of the controlling terminal when we last looked.
+        lastwinsize = get_winsize(1)
         while True:
+            timeout = None
+            if refreshpending is not None:
+                now = time.time()
+                if refreshpending <= now:
+                    t.screen.refresh()
+                    refreshpending = None
+                    idlewait = 0
+                else:
+                    # Wait for further output, but not past the deadline.
+                    timeout = min(idlewait,
+                                  int((refreshpending - now) * 1000) + 1)
             try:
-                res, _, _ = select.select([0, masterfd], [], [],
-                                          refreshpending and 0)
+                res = [fd for fd, _ in poller.poll(timeout)]
             except select.error as err:
                 if err.args[0] == errno.EINTR:
                     t.resized()
                     t.resizepty(masterfd)
                     continue
                 raise
+            # Python 3 retries poll after SIGWINCH instead of raising EINTR,
+            # and curses would only apply the new size during some later
+            # refresh. Catch up before feeding any more output.
+            winsize = get_winsize(1)
+            if winsize != lastwinsize:
+                lastwinsize = winsize
+                curses.resizeterm(*winsize)
+            if t.realscreen.getmaxyx() != t.realsize:
+                t.resized()
+                t.resizepty(masterfd)
             if 0 in res:
+                # Collect all pending keys and pass them on with one write.
+                keys = bytearray()
                 while True:
                     key = t.realscreen.getch()
                     if key == -1:
                         break
                     if key == 0xb3:
+                        if keys:
+                            write_all(masterfd, bytes(keys))
+                            del keys[:]
                         t.switchmode()
                         t.resizepty(masterfd)
                     elif key in keymapping:
-                        os.write(masterfd, keymapping[key])
+                        keys.extend(keymapping[key])
                     elif key <= 0xff:
-                        os.write(masterfd, struct.pack("B", key))
+                        keys.append(key)
                     else:
                         if "TCVT_DEVEL" in os.environ:
                             raise ValueError("getch returned %d" % key)
+                if keys:
+                    write_all(masterfd, bytes(keys))
             elif masterfd in res:
-                try:
-                    data = os.read(masterfd, 1024)
-                except OSError:
-                    break
-                if not data:
+                # Drain everything the child has written so far and refresh
+                # once for the whole burst.
+                now = time.time()
+                data = read_available(masterfd, 65536, 65536)
+                if data is None:
                     break
-                for char in bytearray(data):
-                    if "TCVT_DEVEL" in os.environ:
-                        t.feed(char)
-                    else:
-                        try:
-                            t.feed(char)
-                        except ValueError:
-                            t.feed_reset()
+                t.feed_bytes(data, "TCVT_DEVEL" in os.environ)
                 if refreshpending is None:
-                    refreshpending = time.time() + 0.1
+                    refreshstart = now
+                    refreshpending = now + 0.1
+                elif now - lastdata < 0.03:
+                    # Output keeps streaming in. Postpone the refresh until
+                    # it pauses, but still show progress twice a second.
+                    refreshpending = min(now + 0.1, refreshstart + 0.5)
+                lastdata = time.time()
+                # An application that clears the screen is likely
+                # repainting. Give it a frame's worth of time to finish
+                # instead of showing a half drawn screen. A bare cursor home
+                # is too common, e.g. in prompts, to be taken as a repaint.
+                if b"\x1b[2J" in data:
+                    idlewait = 16
             elif refreshpending is not None:
                 t.screen.refresh()
                 refreshpending = None
-            if refreshpending is not None and refreshpending < time.time():
-                t.screen.refresh()
-                refreshpending = None
+                idlewait = 0
     finally:
         t.stop()
 